@@ -1,119 +1,248 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import os
+import orjson
 import pandas as pd
 from datetime import date, timedelta
 import numpy as np
-import math
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from types import MappingProxyType
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 st.set_page_config(page_title="FedEx Rate Checker", layout="centered")
 
-# --- Secrets via environment variables ---
-CLIENT_ID = os.getenv("FEDEX_CLIENT_ID", "YOUR_FEDEX_CLIENT_ID")
-CLIENT_SECRET = os.getenv("FEDEX_CLIENT_SECRET", "YOUR_FEDEX_CLIENT_SECRET")
-ACCOUNT_NUMBER = os.getenv("FEDEX_ACCOUNT_NUMBER", "YOUR_FEDEX_ACCOUNT_NUMBER")
+# --- Secrets via environment variables (resolved once per browser session) ---
+if "fedex_creds" not in st.session_state:
+    st.session_state["fedex_creds"] = (
+        os.getenv("FEDEX_CLIENT_ID", "YOUR_FEDEX_CLIENT_ID"),
+        os.getenv("FEDEX_CLIENT_SECRET", "YOUR_FEDEX_CLIENT_SECRET"),
+        os.getenv("FEDEX_ACCOUNT_NUMBER", "YOUR_FEDEX_ACCOUNT_NUMBER")
+    )
+CLIENT_ID, CLIENT_SECRET, ACCOUNT_NUMBER = st.session_state["fedex_creds"]
 
 # --- Load ZIP code coordinates, supplier ZIPs, and product data ---
-@st.cache_data
+# Loaders return plain dicts keyed by ZIP / product number so per-lookup cost is
+# a hash plus tuple unpack rather than pandas indexing. ZIPs are kept as ints
+# (00601 -> 601) and only zero-padded when sent to FedEx.
+# The dicts are held with st.cache_resource: every rerun gets the same
+# read-only object back instead of st.cache_data unpickling it again (~34k
+# entries for the ZIP table). Callers must not mutate them.
+@st.cache_resource(show_spinner=False)
 def load_zip_coords():
     zip_df = pd.read_csv("US Zip Codes.csv")
-    zip_df["zip"] = zip_df["zip"].astype(str).str.zfill(5)
-    return zip_df.set_index("zip")
+    zip_df["zip"] = zip_df["zip"].astype(np.uint32)
+    lat_rad = np.radians(zip_df["lat"]).tolist()
+    lng_rad = np.radians(zip_df["lng"]).tolist()
+    return dict(zip(zip_df["zip"].tolist(), zip(lat_rad, lng_rad, zip_df["state_id"])))
 
+@st.cache_resource(show_spinner=False)
 def load_supplier_zips():
     df = pd.read_csv("TEST Supplier Code and Origin Zip.csv")
     df["supplier_code"] = df["supplier_code"].astype(str)
-    df["zip"] = df["zip"].astype(str).str.zfill(5)
-    return df.set_index("supplier_code")
+    df["zip"] = df["zip"].astype(np.uint32)
+    return dict(zip(df["supplier_code"], df["zip"].tolist()))
 
-@st.cache_data
+@st.cache_resource(show_spinner=False)
 def load_product_data():
     df = pd.read_csv("TEST SAMPLE All Products Shipping Info.csv", encoding="utf-8-sig")
     df.columns = df.columns.str.strip()
     df["Product Number"] = df["Product Number"].astype(str).str.strip()
-    df["zip"] = df["zip"].astype(str).str.zfill(5)
-    return df.set_index("Product Number")
+    df["zip"] = df["zip"].astype(np.uint32)
+    columns = ["SupplierCode", "zip", "Weight", "Length", "Width", "Height"]
+    return dict(zip(df["Product Number"], df[columns].itertuples(index=False, name=None)))
 
 zip_coords = load_zip_coords()
 supplier_zips = load_supplier_zips()
 product_data = load_product_data()
 MARKUP_PERCENT = 0.10
+ZIP_RE = re.compile(r"^\d{5}$")
+# State and territory codes that appear in US Zip Codes.csv.
+US_STATES = frozenset({
+    "AL", "AK", "AS", "AZ", "AR", "CA", "CO", "CT", "DE", "DC", "FL", "GA", "GU",
+    "HI", "ID", "IL", "IN", "IA", "KS", "KY", "LA", "ME", "MD", "MA", "MI", "MN",
+    "MS", "MO", "MP", "MT", "NE", "NV", "NH", "NJ", "NM", "NY", "NC", "ND", "OH",
+    "OK", "OR", "PA", "PR", "RI", "SC", "SD", "TN", "TX", "UT", "VT", "VA", "VI",
+    "WA", "WV", "WI", "WY"
+})
+TOKEN_EXPIRY_MARGIN = 60
+EARTH_RADIUS_MILES = 3958.8
+HTTP_POOL_SIZE = 8
+# (connect, read) seconds; without one a stalled FedEx socket hangs the script.
+HTTP_TIMEOUT = (3.05, 10)
 
 # --- Helper Functions ---
-def get_access_token():
+class FedExError(Exception):
+    pass
+
+# FedEx rejected the bearer token (401); the caller refreshes and retries.
+class FedExAuthError(FedExError):
+    pass
+
+# One pooled session per server process so the OAuth and rate calls reuse the
+# same keep-alive connection to apis.fedex.com instead of a new TLS handshake.
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    session.headers.update({"Content-Type": "application/json"})
+    # Token and rate-quote POSTs have no side effects, so they are safe to retry.
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST", "GET"],
+        respect_retry_after_header=True
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry))
+    return session
+
+SESSION = get_http_session()
+
+# Shared across sessions until FedEx's expires_in runs out; see get_access_token.
+@st.cache_resource(show_spinner=False)
+def _fetch_access_token(client_id):
     url = "https://apis.fedex.com/oauth/token"
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
     data = {
         "grant_type": "client_credentials",
-        "client_id": CLIENT_ID,
+        "client_id": client_id,
         "client_secret": CLIENT_SECRET
     }
+    response = SESSION.post(url, headers=headers, data=data, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    payload = orjson.loads(response.content)
+    token = payload.get("access_token")
+    if not token:
+        raise requests.exceptions.RequestException("No access_token in OAuth response")
+    return token, time.time() + payload.get("expires_in", 3600)
+
+@st.cache_resource
+def _token_refresh_lock():
+    return threading.Lock()
+
+def _token_is_stale(token, expires_at, stale_token):
+    return token == stale_token or expires_at <= time.time() + TOKEN_EXPIRY_MARGIN
+
+# stale_token is a token FedEx just rejected. The refresh happens under a lock
+# and only if the cache still holds that token, so concurrent 401s (several
+# sessions, or one batch) share a single OAuth round-trip.
+def get_access_token(stale_token=None):
     try:
-        response = requests.post(url, headers=headers, data=data)
-        response.raise_for_status()
-        return response.json().get("access_token")
-    except requests.exceptions.RequestException as e:
-        st.error(f"OAuth error: {e}")
-        return None
+        token, expires_at = _fetch_access_token(CLIENT_ID)
+        # Refresh a minute early so a request never goes out on a stale token.
+        if _token_is_stale(token, expires_at, stale_token):
+            with _token_refresh_lock():
+                token, expires_at = _fetch_access_token(CLIENT_ID)
+                if _token_is_stale(token, expires_at, stale_token):
+                    _fetch_access_token.clear()
+                    token, expires_at = _fetch_access_token(CLIENT_ID)
+        return token
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        raise FedExError(f"OAuth error: {e}") from e
+
+def parse_zip(text):
+    text = str(text).strip()
+    return int(text) if ZIP_RE.match(text) else None
 
+def state_for_zip(zip_code):
+    coords = zip_coords.get(zip_code)
+    return coords[2] if coords else None
+
+# Takes radians (as stored in zip_coords); works on scalars or arrays.
 def haversine(lat1, lon1, lat2, lon2):
-    R = 3958.8
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlambda = math.radians(lon2 - lon1)
-    a = math.sin(dphi / 2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2)**2
-    return R * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+
+# Pairwise distances between two sets of points (N origins x M destinations).
+# Numba compiles a parallel loop when installed; otherwise NumPy broadcasting.
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def haversine_matrix(lat1, lon1, lat2, lon2):
+        out = np.empty((lat1.size, lat2.size))
+        for i in prange(lat1.size):
+            for j in range(lat2.size):
+                a = (np.sin((lat2[j] - lat1[i]) / 2)**2
+                     + np.cos(lat1[i]) * np.cos(lat2[j]) * np.sin((lon2[j] - lon1[i]) / 2)**2)
+                out[i, j] = 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+        return out
+else:
+    def haversine_matrix(lat1, lon1, lat2, lon2):
+        return haversine(lat1[:, None], lon1[:, None], lat2[None, :], lon2[None, :])
+
+# Ground days by distance: <=150 mi is 1 day, <=450 is 2, ... and beyond 2000 is 5.
+# side="left" keeps each band edge inclusive; also works on arrays of distances.
+_GROUND_BANDS_MILES = np.array([150, 450, 1000, 2000])
+_GROUND_DAYS = np.array([1, 2, 3, 4, 5])
 
 def estimate_ground_transit_days(origin_zip, dest_zip):
     try:
-        o = zip_coords.loc[str(origin_zip)]
-        d = zip_coords.loc[str(dest_zip)]
-        dist = haversine(o.lat, o.lng, d.lat, d.lng)
-        if dist <= 150:
-            return 1
-        elif dist <= 450:
-            return 2
-        elif dist <= 1000:
-            return 3
-        elif dist <= 2000:
-            return 4
-        else:
-            return 5
+        o_lat, o_lng, _ = zip_coords[int(origin_zip)]
+        d_lat, d_lng, _ = zip_coords[int(dest_zip)]
+        dist = haversine(o_lat, o_lng, d_lat, d_lng)
+        return _GROUND_DAYS[np.searchsorted(_GROUND_BANDS_MILES, dist, side="left")]
     except KeyError:
         return 5
 
-def get_list_rates(origin_zip, dest_zip, origin_state, dest_state, weight_lb, length, width, height, token):
-    if not token:
-        return {"error": "Unable to get access token."}
+def _zip_radians(zips):
+    coords = [zip_coords.get(int(z)) for z in zips]
+    known = np.array([c is not None for c in coords], dtype=bool)
+    lat = np.array([c[0] if c else 0.0 for c in coords])
+    lng = np.array([c[1] if c else 0.0 for c in coords])
+    return lat, lng, known
 
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
+# Ground days for every origin/destination pair; unknown ZIPs get the 5-day
+# fallback like estimate_ground_transit_days. Unknown coordinates are masked
+# rather than passed as NaN, which fastmath does not handle.
+def bulk_estimate_transit_days(origin_zips, dest_zips):
+    o_lat, o_lng, o_known = _zip_radians(origin_zips)
+    d_lat, d_lng, d_known = _zip_radians(dest_zips)
+    dist = haversine_matrix(o_lat, o_lng, d_lat, d_lng)
+    days = _GROUND_DAYS[np.searchsorted(_GROUND_BANDS_MILES, dist, side="left")]
+    days[~(o_known[:, None] & d_known[None, :])] = _GROUND_DAYS[-1]
+    return days
+
+RATE_URL = "https://apis.fedex.com/rate/v1/rates/quotes"
+# Fields that never vary between rate requests; shared by every body, not copied.
+_RATE_SHIPMENT_TEMPLATE = {
+    "pickupType": "DROPOFF_AT_FEDEX_LOCATION",
+    "packagingType": "YOUR_PACKAGING",
+    "rateRequestType": ["LIST"]
+}
+
+# packages is a sequence of (weight_lb, length, width, height) tuples rated as one
+# multi-piece shipment on the lane, so a cart from one origin costs one POST.
+def get_list_rates(origin_zip, dest_zip, origin_state, dest_state, packages, token, ship_date=None):
+    headers = {"Authorization": f"Bearer {token}"}
 
     body = {
         "accountNumber": {"value": ACCOUNT_NUMBER},
-        "shipDate": date.today().isoformat(),
+        "shipDate": ship_date or date.today().isoformat(),
         "requestedShipment": {
+            **_RATE_SHIPMENT_TEMPLATE,
             "shipper": {
                 "address": {
-                    "postalCode": origin_zip,
+                    "postalCode": f"{origin_zip:05d}",
                     "stateOrProvinceCode": origin_state,
                     "countryCode": "US"
                 }
             },
             "recipient": {
                 "address": {
-                    "postalCode": dest_zip,
+                    "postalCode": f"{dest_zip:05d}",
                     "stateOrProvinceCode": dest_state,
                     "countryCode": "US",
                     "residential": False
                 }
             },
-            "pickupType": "DROPOFF_AT_FEDEX_LOCATION",
-            "packagingType": "YOUR_PACKAGING",
-            "rateRequestType": ["LIST"],
             "requestedPackageLineItems": [
                 {
                     "weight": {"units": "LB", "value": weight_lb},
@@ -124,32 +253,81 @@ def get_list_rates(origin_zip, dest_zip, origin_state, dest_state, weight_lb, le
                         "units": "IN"
                     }
                 }
+                for weight_lb, length, width, height in packages
             ]
         }
     }
+    data = orjson.dumps(body, option=orjson.OPT_SERIALIZE_NUMPY)
 
     try:
-        response = requests.post("https://apis.fedex.com/rate/v1/rates/quotes", headers=headers, json=body)
+        response = SESSION.post(RATE_URL, headers=headers, data=data, timeout=HTTP_TIMEOUT)
+        if response.status_code == 401:
+            raise FedExAuthError("FedEx rejected the access token (401).")
         response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        return {"error": f"API request failed: {e}"}
+        return orjson.loads(response.content)
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        raise FedExError(f"API request failed: {e}") from e
+
+def _rates_or_error(spec, token):
+    try:
+        return get_list_rates(*spec, token)
+    except FedExError as e:
+        return e
+
+# Quotes are independent, so fan them out over the pooled session; one worker
+# per pooled connection keeps every request on a warm keep-alive socket.
+# Each spec is get_list_rates' positional args minus the token; a failed
+# quote comes back as its FedExError in place of the response. Workers never
+# refresh the token themselves: quotes rejected with a 401 are retried once,
+# after a single refresh on the calling (script) thread.
+def get_list_rates_many(specs, token):
+    with ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE) as executor:
+        responses = list(executor.map(lambda spec: _rates_or_error(spec, token), specs))
+        rejected = [i for i, r in enumerate(responses) if isinstance(r, FedExAuthError)]
+        if rejected:
+            try:
+                token = get_access_token(stale_token=token)
+            except FedExError as e:
+                # Report the failed refresh on the rejected rows and keep the rest.
+                for i in rejected:
+                    responses[i] = e
+            else:
+                retried = executor.map(lambda i: _rates_or_error(specs[i], token), rejected)
+                for i, response in zip(rejected, retried):
+                    responses[i] = response
+    return responses
 
 def add_business_days(start_date, business_days):
-    date_range = pd.bdate_range(start=start_date, periods=business_days + 1).tolist()
-    return date_range[-1].date().isoformat()
+    # A weekend start rolls forward to Monday first, as pd.bdate_range did.
+    return str(np.busday_offset(np.datetime64(start_date, "D"), business_days, roll="forward"))
+
+def _charge(detail):
+    charge = detail.get("totalNetFedExCharge") or (detail.get("shipmentRateDetail") or {}).get("totalNetFedExCharge")
+    # FedEx v1 almost always sends the {"amount", "currency"} form; only fall
+    # back to type checks when that lookup fails.
+    try:
+        return charge["amount"], charge["currency"]
+    except (TypeError, KeyError):
+        if isinstance(charge, (int, float)):
+            return charge, "USD"
+        if isinstance(charge, dict):
+            return charge.get("amount"), charge.get("currency")
+        return None, None
+
+FIXED_DAYS_BY_SERVICE = MappingProxyType({
+    "FIRST_OVERNIGHT": 1,
+    "PRIORITY_OVERNIGHT": 1,
+    "STANDARD_OVERNIGHT": 1,
+    "FEDEX_2_DAY_AM": 2,
+    "FEDEX_2_DAY": 2,
+    "FEDEX_EXPRESS_SAVER": 3
+})
 
 def extract_selected_rates(response, origin_zip, dest_zip):
     results = []
-    fixed_days_by_service = {
-        "FIRST_OVERNIGHT": 1,
-        "PRIORITY_OVERNIGHT": 1,
-        "STANDARD_OVERNIGHT": 1,
-        "FEDEX_2_DAY_AM": 2,
-        "FEDEX_2_DAY": 2,
-        "FEDEX_EXPRESS_SAVER": 3
-    }
-
+    today = date.today()
+    # Several services share a day count, so each delivery date is computed once.
+    delivery_by_days = {}
     rate_details = response.get("output", {}).get("rateReplyDetails", [])
     for item in rate_details:
         service_type = item.get("serviceType", "UNKNOWN")
@@ -158,36 +336,102 @@ def extract_selected_rates(response, origin_zip, dest_zip):
         if service_type == "FEDEX_GROUND":
             days = estimate_ground_transit_days(origin_zip, dest_zip)
         else:
-            days = fixed_days_by_service.get(service_type, None)
+            days = FIXED_DAYS_BY_SERVICE.get(service_type)
 
-        delivery_date = add_business_days(date.today(), days) if days else "Estimate unavailable"
+        if not days:
+            delivery_date = "Estimate unavailable"
+        elif days in delivery_by_days:
+            delivery_date = delivery_by_days[days]
+        else:
+            delivery_date = delivery_by_days[days] = add_business_days(today, days)
 
         for detail in item.get("ratedShipmentDetails", []):
-            charge = detail.get("totalNetFedExCharge")
-            if not charge:
-                shipment_detail = detail.get("shipmentRateDetail") or {}
-                charge = shipment_detail.get("totalNetFedExCharge")
-
-            if isinstance(charge, dict):
-                amount = charge.get("amount")
-                currency = charge.get("currency")
-            elif isinstance(charge, (int, float)):
-                amount = charge
-                currency = "USD"
-            else:
-                amount = None
-                currency = None
-
+            amount, currency = _charge(detail)
             if amount and currency:
-                marked_up = round(amount * (1 + MARKUP_PERCENT), 2)
                 results.append({
                     "Service": service_name,
-                    "List Rate": f"{amount} {currency}",
-                    "DS Rate": f"{marked_up} {currency}",
+                    "amount": float(amount),
+                    "currency": currency,
                     "Estimated Delivery": delivery_date
                 })
     return results
 
+def format_rates(rates):
+    return [{
+        "Service": r["Service"],
+        "List Rate": f"{r['amount']:.2f} {r['currency']}",
+        "DS Rate": f"{r['amount'] * (1 + MARKUP_PERCENT):.2f} {r['currency']}",
+        "Estimated Delivery": r["Estimated Delivery"]
+    } for r in rates]
+
+# Rates for a given lane, package and ship date don't change, so repeat lookups
+# skip the token and rate round-trips entirely. ship_date is part of the key so
+# a cached reply never outlives its day. A FedExError is raised, so failures
+# are never cached.
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def fetch_rates(origin_zip, dest_zip, origin_state, dest_state, packages, ship_date):
+    token = get_access_token()
+    try:
+        response = get_list_rates(origin_zip, dest_zip, origin_state, dest_state, packages, token, ship_date)
+    except FedExAuthError:
+        # Cached token was revoked or expired early; refresh once and retry.
+        token = get_access_token(stale_token=token)
+        response = get_list_rates(origin_zip, dest_zip, origin_state, dest_state, packages, token, ship_date)
+    return response, extract_selected_rates(response, origin_zip, dest_zip)
+
+BATCH_COLUMNS = ["origin", "dest", "weight", "length", "width", "height"]
+
+# Blank cells arrive as NaN, which float() accepts and orjson would send as
+# null, so anything that is not a finite positive number is rejected here.
+def _parse_package(weight, length, width, height):
+    try:
+        package = (float(weight), int(length), int(width), int(height))
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if not (np.isfinite(package[0]) and all(v > 0 for v in package)):
+        return None
+    return package
+
+def quote_batch(batch):
+    shipments = []
+    for origin, dest, weight, length, width, height in batch[BATCH_COLUMNS].itertuples(index=False):
+        origin = "" if pd.isna(origin) else str(origin).strip()
+        dest = "" if pd.isna(dest) else str(dest).strip()
+        origin_zip = parse_zip(origin.zfill(5)) if origin else None
+        dest_zip = parse_zip(dest.zfill(5)) if dest else None
+        package = _parse_package(weight, length, width, height)
+        origin_state = state_for_zip(origin_zip)
+        dest_state = state_for_zip(dest_zip)
+        shipments.append((origin, dest, origin_zip, dest_zip, origin_state, dest_state, package))
+
+    specs = [
+        (origin_zip, dest_zip, origin_state, dest_state, [package])
+        for _, _, origin_zip, dest_zip, origin_state, dest_state, package in shipments
+        if origin_state and dest_state and package
+    ]
+    # A file with no quotable rows never needs a token.
+    responses = iter(())
+    if specs:
+        token = get_access_token()
+        responses = iter(get_list_rates_many(specs, token))
+
+    rows = []
+    for origin, dest, origin_zip, dest_zip, origin_state, dest_state, package in shipments:
+        lane = {"Origin": origin, "Destination": dest}
+        if not package:
+            rows.append({**lane, "Error": "Invalid weight or dimensions."})
+            continue
+        if not (origin_state and dest_state):
+            rows.append({**lane, "Error": "Unknown ZIP code."})
+            continue
+        response = next(responses)
+        if isinstance(response, FedExError):
+            rows.append({**lane, "Error": str(response)})
+            continue
+        rates = sorted(extract_selected_rates(response, origin_zip, dest_zip), key=itemgetter("amount"))
+        rows.extend({**lane, **r} for r in format_rates(rates))
+    return rows
+
 # --- Streamlit UI ---
 st.title("\U0001F4E6 FedEx Rate Checker")
 st.markdown("Check retail (list) rates for FedEx Ground, 2Day, and Overnight services.")
@@ -205,49 +449,86 @@ with st.form("rate_form"):
 
     submitted = st.form_submit_button("Get Rates")
 
-if submitted:
+# A fragment, so the raw-response toggle reruns only this section and not the
+# forms or the batch quote below.
+@st.fragment
+def render_results(product_number, destination, dest_state):
+    # Fail fast on bad input rather than spending an OAuth + rate round-trip on it.
+    if product_number not in product_data:
+        st.error(f"Product number '{product_number}' not found in product catalog.")
+        return
+    dest_zip = parse_zip(destination)
+    if dest_zip is None:
+        st.error("Destination ZIP code must be exactly 5 digits.")
+        return
+    if dest_state not in US_STATES:
+        st.error(f"'{dest_state}' is not a US state code, e.g. CA.")
+        return
+    supplier_code, origin, weight, length, width, height = product_data[product_number]
+    origin_state = state_for_zip(origin)
+    if not origin_state:
+        st.error(f"No state on file for origin ZIP {origin:05d}.")
+        return
+
+    packages = ((float(weight), int(length), int(width), int(height)),)
     try:
-        product = product_data.loc[product_number.strip()]
-        supplier_code = product["SupplierCode"]
-        origin = product["zip"]
-        weight = float(product["Weight"])
-        length = int(product["Length"])
-        width = int(product["Width"])
-        height = int(product["Height"])
-        origin_state = zip_coords.loc[origin, "state_id"]
+        response, rates = fetch_rates(origin, dest_zip, origin_state, dest_state, packages, date.today().isoformat())
+    except FedExError as e:
+        st.error(str(e))
+        return
 
-        token = get_access_token()
-        if token:
-            response = get_list_rates(origin, destination, origin_state, dest_state, weight, length, width, height, token)
-            if "error" in response:
-                st.error(response["error"])
+    if rates:
+        st.success("Here are the available list rates:")
+        rates.sort(key=itemgetter("amount"))
+        st.table(pd.DataFrame(format_rates(rates)).set_index("Service"))
+    else:
+        st.warning("No matching list rates returned for the specified inputs.")
+
+    alerts = response.get("output", {}).get("alerts", [])
+    if alerts:
+        st.info("FedEx API Alerts:")
+        for alert in alerts:
+            code = alert.get("code")
+            message = alert.get("message")
+            st.write(f"- ({code}) {message}")
+
+    if st.toggle("Show full FedEx API response"):
+        try:
+            st.code(orjson.dumps(response, option=orjson.OPT_INDENT_2).decode(), language="json")
+        except orjson.JSONEncodeError:
+            st.write("Raw response:")
+            st.write(response)
+
+# Remember the last submitted query so reruns (e.g. the raw-response toggle)
+# keep showing its results; fetch_rates serves them from cache.
+if submitted:
+    st.session_state["last_query"] = (product_number.strip(), destination.strip(), dest_state.strip().upper())
+
+if "last_query" in st.session_state:
+    render_results(*st.session_state["last_query"])
+
+st.markdown("### Batch Quote")
+with st.form("batch_form"):
+    uploaded = st.file_uploader(f"Shipments CSV with columns: {', '.join(BATCH_COLUMNS)}", type="csv")
+    batch_submitted = st.form_submit_button("Get Batch Rates")
+
+if batch_submitted and uploaded is not None:
+    try:
+        batch = pd.read_csv(uploaded, dtype={"origin": str, "dest": str})
+    except (pd.errors.EmptyDataError, pd.errors.ParserError, UnicodeDecodeError, ValueError) as e:
+        st.error(f"Could not read the batch CSV: {e}")
+    else:
+        missing = [c for c in BATCH_COLUMNS if c not in batch.columns]
+        if missing:
+            st.error(f"Batch file is missing columns: {', '.join(missing)}")
+        else:
+            try:
+                with st.spinner(f"Quoting {len(batch)} shipments..."):
+                    rows = quote_batch(batch)
+            except FedExError as e:
+                st.error(str(e))
             else:
-                rates = extract_selected_rates(response, origin, destination)
-                if rates:
-                    st.success("Here are the available list rates:")
-                    df = pd.DataFrame(rates)
-                    df["Numeric"] = df["Marked Up Rate"].str.extract(r'(\d+\.\d+)').astype(float)
-                    df = df.sort_values(by="Numeric").drop(columns="Numeric")
-                    st.table(df[["Service", "List Rate", "DS Rate", "Estimated Delivery"]].set_index("Service"))
+                if rows:
+                    st.dataframe(pd.DataFrame(rows), hide_index=True)
                 else:
-                    st.warning("No matching list rates returned for the specified inputs.")
-
-                alerts = response.get("output", {}).get("alerts", [])
-                if alerts:
-                    st.info("FedEx API Alerts:")
-                    for alert in alerts:
-                        code = alert.get("code")
-                        message = alert.get("message")
-                        st.write(f"- ({code}) {message}")
-
-                with st.expander("See full FedEx API response"):
-                    try:
-                        st.json(response)
-                    except Exception:
-                        st.write("Raw response:")
-                        st.write(response)
-        else:
-            st.error("Failed to get FedEx access token.")
-
-    except KeyError:
-        st.error(f"Product number '{product_number}' not found in product catalog.")
+                    st.warning("No rates returned for the uploaded shipments.")